@@ -14,32 +14,57 @@ Options:
   -h --help     Show this screen
   --version     Show version
 """
-import configparser
+import gzip
+import io
 import json
 import os
+import re
 import shutil
 import subprocess
 import sys
+import tarfile
 import tempfile
 import uuid
-from collections import deque
 from dataclasses import dataclass
 from docopt_ng import docopt
-from glob import glob
+from functools import cached_property
 from pathlib import Path, PurePath
 from time import time
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import pprint
 pp_ = pprint.PrettyPrinter(indent=2)
 pp = pp_.pprint
 
 SCRIPTPATH = os.path.dirname(os.path.realpath(__file__))
 
+
+def read_config(filename):
+    """ Read `key=value` or `key: value` options, ignoring section headers
+    and comments; keys are lowercased, as configparser does """
+    config = {}
+    with open(filename) as CONFIGFILE:
+        for line in CONFIGFILE:
+            line = line.strip()
+            if not line or line[0] in '#;[':
+                continue
+            option = re.split(r'[=:]', line, maxsplit=1)
+            if len(option) == 2:
+                config[option[0].strip().lower()] = option[1].strip()
+    return config
+
+
 # read config file
-config = configparser.ConfigParser()
-config.read(f"{SCRIPTPATH}/remtool.cfg")
+config = read_config(f"{SCRIPTPATH}/remtool.cfg")
 CONFIG = {}
-CONFIG['SSH_HOSTNAME'] = config['main']['reMarkableHostname']
+CONFIG['SSH_HOSTNAME'] = config['remarkablehostname']
+
+# matches the fileType entry of a .content file
+FILETYPE_RE = re.compile(r'"fileType"\s*:\s*"([^"]*)"')
 
 # color codes for pretty output
 colors = {
@@ -57,12 +82,112 @@ def colored(c, text):
     return colors[c] + text + colors['RESET']
 
 
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode('utf-8')
+
+
+# default .content for new documents, by filetype
+_DEFAULT_CONTENT = {
+    'pdf': {
+        'extraMetadata': {
+            'LastFinelinerv2Color': 'Black',
+            'LastFinelinerv2Size': '2',
+            'LastPen': 'Finelinerv2',
+            'LastTool': 'Finelinerv2'
+        },
+        'zoomMode': 'fitToHeight'
+    },
+    'epub': {
+        'extraMetadata': {
+            'LastPen': 'Highlighterv2',
+            'LastTool': 'Highlighterv2',
+            'LastHighlighterv2Color': 'HighlighterYellow'
+        },
+        'coverPageNumber': 0,
+        'fontName': 'Noto Serif',
+        'lineHeight': 100,
+        'margins': 125,
+        'textAlignment': 'justify',
+        'textScale': 1
+    },
+}
+# ...and the same, serialized once up front
+_DEFAULT_CONTENT_JSON = {filetype: json_dumps(content)
+                         for filetype, content in _DEFAULT_CONTENT.items()}
+_EMPTY_CONTENT_JSON = json_dumps({})
+
+
+def _metadata_item(filename, lines, filetypes):
+    # assemble one item, as consumed by ContentTree, from the lines of a
+    # .metadata file
+    stem = os.path.splitext(filename)[0]
+    return {'filename': filename,
+            'metadata': json_loads('\n'.join(lines)),
+            'filetype': filetypes.pop(stem, '')}
+
+
+def _owned_by_root(tarinfo):
+    # files on the device belong to root, like they would after an scp
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = 'root'
+    return tarinfo
+
+
+def _add_to_tar(tar, name: str, data: bytes=None):
+    # add an in-memory file to the tarfile, or a folder if there's no data
+    tarinfo = _owned_by_root(tarfile.TarInfo(name))
+    tarinfo.mtime = int(time())
+    if data is None:
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o755
+        tar.addfile(tarinfo)
+    else:
+        tarinfo.size = len(data)
+        tarinfo.mode = 0o644
+        tar.addfile(tarinfo, io.BytesIO(data))
+
+
 class reMarkable:
     def __init__(self, hostname: str):
         self.hostname = hostname
 
+        # open a persistent master connection so every ssh/scp call below
+        # reuses it instead of doing its own handshake
+        self._controldir = tempfile.mkdtemp(prefix='remtool_')
+        self._controlpath = f"{self._controldir}/ssh"
+        self._ssh_opts = ['-o', f"ControlPath={self._controlpath}",
+                          '-o', 'ControlMaster=no']
+        self._start_master()
+
         # get content tree and metadata from reMarkable
-        self.ct = ContentTree(self._get_metadata())
+        try:
+            self.ct = ContentTree(self._get_metadata())
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._controldir is None:
+            return
+        subprocess.run(['ssh', '-o', f"ControlPath={self._controlpath}",
+                        '-O', 'exit', f"root@{self.hostname}"],
+                       capture_output=True)
+        shutil.rmtree(self._controldir, ignore_errors=True)
+        self._controldir = None
 
     def put(self, file: str, folder: str='', force_overwrite: bool=False,
             clear_annotations: bool=False):
@@ -108,16 +233,12 @@ class reMarkable:
                                 visible_name=filename.stem)
             new_node = Node(uuid=uuid.uuid4(), metadata=new_meta,
                             filetype=source_type)
-            parent.add_child(new_node)
-
-            # render node as files on disk and send them to the device
-            with tempfile.TemporaryDirectory(prefix='remtool_') as tempdir:
-                new_node.render_to_disk(tempdir)
-                shutil.copy(filename,
-                            f"{tempdir}/{new_node.uuid}{filename.suffix}")
-                rendered = glob(f"{tempdir}/*")
-                self._scp(rendered, '.local/share/remarkable/xochitl')
-                self._ssh('systemctl restart xochitl')
+            self.ct.add_node(parent, new_node)
+
+            # send the rendered node and the file itself to the device
+            self._tar_scp(new_node, filename,
+                          '.local/share/remarkable/xochitl',
+                          ['systemctl restart xochitl'])
             print(colored('GREEN', 'Success.'))
         else:
             print(colored('BOLDYELLOW',
@@ -134,32 +255,26 @@ class reMarkable:
             else:
                 print(colored('BOLDYELLOW', 'Forcing overwrite...'))
 
+            # clean up stale files and restart in the same session as the
+            # upload; none of these paths are part of the upload, and
+            # xochitl only picks up the changes once it's restarted
+            then = []
+            # if this is an epub, delete pre-rendered pdf on device
+            if target.filetype == 'epub':
+                then.append(f"rm -f {target.uuid}.pdf "
+                            f"{target.uuid}.epubindex "
+                            f"{target.uuid}.pagedata")
+            # delete thumbnails
+            then.append(f"rm -f {target.uuid}.thumbnails/*")
+            # delete annotation files, if option is set
+            if clear_annotations:
+                print(colored('BOLDYELLOW', 'Clearing annotations...'))
+                then.append(f"rm -f {target.uuid}/*")
+            then.append('systemctl restart xochitl')
+
             # copy file over existing one on device
-            with tempfile.TemporaryDirectory(prefix='remtool_') as tempdir:
-                # render file to disk
-                target.render_to_disk(tempdir)
-                # if this is an epub, delete pre-rendered pdf on device first
-                if target.filetype == 'epub':
-                    self._ssh(
-                        f"rm -f "
-                        f".local/share/remarkable/xochitl/{target.uuid}.pdf "
-                        f".local/share/remarkable/xochitl/{target.uuid}.epubindex "
-                        f".local/share/remarkable/xochitl/{target.uuid}.pagedata "
-                    )
-                # delete thumbnails
-                self._ssh(f"rm -f .local/share/remarkable/xochitl/"
-                          f"{target.uuid}.thumbnails/*")
-                # delete annotation files, if option is set
-                if clear_annotations:
-                    print(colored('BOLDYELLOW', 'Clearing annotations...'))
-                    self._ssh(f"rm -f .local/share/remarkable/xochitl/"
-                              f"{target.uuid}/*")
-                # now we can do the actual file copy
-                shutil.copy(filename,
-                            f"{tempdir}/{target.uuid}.{target.filetype}")
-                rendered = glob(f"{tempdir}/*")
-                self._scp(rendered, '.local/share/remarkable/xochitl')
-                self._ssh('systemctl restart xochitl')
+            self._tar_scp(target, filename,
+                          '.local/share/remarkable/xochitl', then)
             print(colored('GREEN', 'Success.'))
 
     def show(self, path: str):
@@ -192,76 +307,183 @@ class reMarkable:
         for child in target.children:
             print(child.path)
 
-    def _ssh(self, cmd: str, pipe_in: bool=False):
-        args = ['ssh', f"root@{self.hostname}"]
+    def _start_master(self):
+        # output has to go to /dev/null, otherwise the backgrounded master
+        # keeps the pipes open and subprocess.run() never returns; if this
+        # fails, later calls fall back to direct connections and report
+        # the actual error
+        args = ['ssh', '-M', '-N', '-f',
+                '-o', 'ControlMaster=yes',
+                '-o', f"ControlPath={self._controlpath}",
+                '-o', 'ControlPersist=60s',
+                f"root@{self.hostname}"]
+        subprocess.run(args, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _ensure_master(self):
+        # restart the master connection if it has gone away, e.g. because
+        # ControlPersist expired
+        args = ['ssh', '-o', f"ControlPath={self._controlpath}",
+                '-O', 'check', f"root@{self.hostname}"]
+        check = subprocess.run(args, capture_output=True)
+        if check.returncode != 0:
+            self._start_master()
+
+    def _ssh_args(self, cmd: str, pipe_in: bool=False,
+                  compress: bool=False):
+        args = ['ssh', *self._ssh_opts, f"root@{self.hostname}"]
         if pipe_in:
             args.insert(1, '-T')  # disable pseudo-terminal allocation
+            remote_cmd = 'sh -s'
         else:
-            args.append(cmd)
-
-        if pipe_in:
-            sp = subprocess.Popen(args,
+            remote_cmd = cmd
+        if compress:
+            # gzip the output on the device; ssh -C can't be used for a
+            # single command since compression is set per connection, and
+            # the master connection also carries the (already compressed)
+            # pdf/epub uploads. The command's exit status is passed out of
+            # the pipeline on fd 4, so failures aren't masked by gzip's.
+            remote_cmd = ('exec 3>&1; status=$({ { '
+                          f"{remote_cmd}; echo $? >&4; "
+                          '} | gzip -c >&3; } 4>&1); exit $status')
+        args.append(remote_cmd)
+        return args
+
+    def _ssh_lines(self, cmd: str, pipe_in: bool=False,
+                   compress: bool=False):
+        """ Run a command on the device (or, with pipe_in, a script fed to
+        it on stdin) and yield its output line by line as it arrives """
+        # stderr goes to a file rather than a pipe: it's only read once
+        # stdout is done, and a full pipe would block the remote side
+        with tempfile.TemporaryFile() as ERRFILE:
+            sp = subprocess.Popen(self._ssh_args(cmd, pipe_in, compress),
                                   stdin=subprocess.PIPE,
                                   stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE,
-                                  encoding='utf-8')
-            result, err = sp.communicate(cmd)
-            if sp.returncode > 0:
-                print(f"ERROR: {err.strip()}")
-                sys.exit(1)
-        else:
+                                  stderr=ERRFILE)
+            if pipe_in:
+                sp.stdin.write(cmd.encode('utf-8'))
+            sp.stdin.close()
+
+            out = sp.stdout
+            if compress:
+                out = gzip.GzipFile(fileobj=out)
+            truncated = False
             try:
-                out = subprocess.run(args, capture_output=True, check=True,
-                                     encoding='utf-8')
-                result = out.stdout
-            except subprocess.CalledProcessError as e:
-                print(f"ERROR: {e}")
-                sys.exit(1)
-        return result
-
-    def _scp(self, source: list, dest: str):
-        args = ['scp', '-r']
-        args.extend(source)
-        args.append(f"root@{self.hostname}:{dest}")
+                # split on \n only, str.splitlines() would also split on
+                # unicode line separators inside json strings
+                for line in io.TextIOWrapper(out, encoding='utf-8',
+                                             newline='\n'):
+                    yield line.rstrip('\n')
+            except (EOFError, gzip.BadGzipFile):
+                # the connection dropped mid-stream; ssh's stderr says why
+                truncated = True
+
+            sp.wait()
+            ERRFILE.seek(0)
+            err = ERRFILE.read().decode('utf-8', errors='replace')
+        if truncated or sp.returncode > 0:
+            print(f"ERROR: {err.strip()}")
+            sys.exit(1)
 
-        try:
-            subprocess.run(args, capture_output=True, check=True,
-                           encoding='utf-8')
-        except subprocess.CalledProcessError as e:
-            print(f"ERROR: {e}")
+    def _tar_scp(self, node, source: Path, dest: str, then: list=None):
+        """ Stream the rendered node plus the source file (stored under the
+        node's uuid) into dest on the device as a tar archive, then run the
+        commands in `then` from dest if the upload succeeded, all in a
+        single ssh session """
+        # the master connection may have timed out, e.g. while waiting on
+        # the overwrite prompt
+        self._ensure_master()
+
+        remote_cmd = f"cd {dest} && tar -xf -"
+        if then:
+            # once the files are in place, always run all of the follow-up
+            # commands, so a failing cleanup step can't skip the restart
+            remote_cmd += f" && {{ {'; '.join(then)}; }}"
+        args = ['ssh', *self._ssh_opts, f"root@{self.hostname}", remote_cmd]
+
+        # open the source before connecting, so a missing or unreadable file
+        # fails here without anything reaching the device; adding it from
+        # the open file also follows symlinks, like a plain copy would
+        with open(source, 'rb') as SOURCE:
+            sp = subprocess.Popen(args,
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE)
+            try:
+                tar = tarfile.open(fileobj=sp.stdin, mode='w|')
+                node.render_to_tar(tar)
+                tarinfo = tar.gettarinfo(
+                    fileobj=SOURCE, arcname=f"{node.uuid}.{node.filetype}")
+                # fstat's float mtime would make tarfile add a pax header;
+                # keep every entry plain ustar for the device's tar
+                tarinfo.mtime = int(tarinfo.mtime)
+                tar.addfile(_owned_by_root(tarinfo), SOURCE)
+                tar.close()
+                sp.stdin.close()
+            except BrokenPipeError:
+                # remote side went away early, the error is reported below
+                pass
+            except BaseException:
+                # don't let a partial archive reach the device; the tarfile
+                # is deliberately not closed, as that would flush it
+                sp.kill()
+                sp.wait()
+                raise
+        err = sp.stderr.read().decode('utf-8', errors='replace')
+        sp.wait()
+        if sp.returncode > 0:
+            print(f"ERROR: {err.strip()}")
             sys.exit(1)
         return True
 
     def _get_metadata(self):
+        # a single awk process prints every .metadata file in full, but only
+        # the fileType line of each .content file (those can be large, e.g.
+        # page lists), with each line prefixed by its filename and a tab;
+        # awk reads the .metadata filenames from stdin (printf is a shell
+        # builtin, so this stays linear in the number of documents) and
+        # emits each .content file right before its .metadata file
         cmd = '''
-shopt -s nullglob
-metafiles=(.local/share/remarkable/xochitl/*.metadata)
-numfiles=${#metafiles[@]}
-
-filecount=1
-echo '['
-for file in ${metafiles[@]}
-do
-    uuid="${file%.*}"
-    tmp=`grep fileType $uuid.content`
-    if [[ $tmp =~ :\ \\"(.+)\\", ]]; then
-        filetype=${BASH_REMATCH[1]}
-    else
-        filetype=""
-    fi
-    echo '{"filename": "'$file'", "metadata": '
-    cat $file
-    echo ', "filetype": "'$filetype'"}'
-    if [[ $filecount -lt $numfiles ]]; then
-        echo ','
-    fi
-    filecount=$(($filecount + 1))
-done
-echo ']'
+cd .local/share/remarkable/xochitl || exit 1
+printf '%s\\n' *.metadata | awk '
+{
+    metafile = $0
+    content = metafile
+    sub(/\\.metadata$/, ".content", content)
+    while ((getline line < content) > 0)
+        if (line ~ /"fileType"/)
+            print content "\\t" line
+    close(content)
+    while ((getline line < metafile) > 0)
+        print metafile "\\t" line
+    close(metafile)
+}
+'
         '''.strip()
-        raw_meta = self._ssh(cmd, pipe_in=True)
-        json_meta = json.loads(raw_meta)
-        return json_meta
+
+        # hand each item on as soon as the last line of its .metadata file
+        # has arrived, so the tree is built while the rest is still coming in
+        filetypes = {}
+        metafile = None
+        lines = []
+        for line in self._ssh_lines(cmd, pipe_in=True, compress=True):
+            filename, _, text = line.partition('\t')
+            if metafile is not None and filename != metafile:
+                yield _metadata_item(metafile, lines, filetypes)
+                metafile = None
+                lines = []
+
+            stem, ext = os.path.splitext(filename)
+            if ext == '.metadata':
+                metafile = filename
+                lines.append(text)
+            elif ext == '.content':
+                match = FILETYPE_RE.search(text)
+                if match:
+                    filetypes[stem] = match.group(1)
+
+        if metafile is not None:
+            yield _metadata_item(metafile, lines, filetypes)
 
 
 @dataclass
@@ -279,36 +501,33 @@ class Metadata:
     version: int
     visible_name: str
 
+    # (attribute name, key in the .metadata json) for every field
+    _JSON_FIELDS = (('deleted', 'deleted'),
+                    ('last_modified', 'lastModified'),
+                    ('last_opened', 'lastOpened'),
+                    ('last_opened_page', 'lastOpenedPage'),
+                    ('metadata_modified', 'metadatamodified'),
+                    ('modified', 'modified'),
+                    ('parent', 'parent'),
+                    ('pinned', 'pinned'),
+                    ('synced', 'synced'),
+                    ('type_', 'type'),
+                    ('version', 'version'),
+                    ('visible_name', 'visibleName'))
+    _STR_WIDTH = max(len(f_) for f_, _ in _JSON_FIELDS)+1
+
     def as_dict(self):
-        out = {}
-        for f_ in Metadata.__dataclass_fields__:
-            if f_ == 'type_':
-                field = 'type'
-            elif f_ == 'visible_name':
-                field = 'visibleName'
-            elif f_ == 'metadata_modified':
-                field = 'metadatamodified'
-            elif f_ == 'last_modified':
-                field = 'lastModified'
-            elif f_ == 'last_opened':
-                field = 'lastOpened'
-            elif f_ == 'last_opened_page':
-                field = 'lastOpenedPage'
-            else:
-                field = f_
-            out[field] = getattr(self, f_)
-        return out
+        return {field: getattr(self, f_) for f_, field in self._JSON_FIELDS}
 
     def __str__(self):
         """ Convert metadata into a human-readable string """
-        width = max([len(fname) for fname in Metadata.__dataclass_fields__])+1
         out = ''
-        for f_ in Metadata.__dataclass_fields__:
+        for f_, _ in self._JSON_FIELDS:
             if f_ == 'type_':
                 field = 'type'
             else:
                 field = f_
-            out += f"{field.ljust(width)}: {getattr(self, f_)}\n"
+            out += f"{field.ljust(self._STR_WIDTH)}: {getattr(self, f_)}\n"
         return out.strip()
 
 
@@ -318,19 +537,25 @@ class Node:
         self.uuid = uuid
         self.metadata = metadata
         self.filetype = filetype
-        self.path = ''
+        self.parent = None
         self.content = {}
         if children is None:
             self.children = []
 
+    @cached_property
+    def path(self):
+        if self.parent is None:
+            return ''
+        suffix = '/' if self.is_folder() else ''
+        return f"{self.parent.path}{self.metadata.visible_name}{suffix}"
+
+    @cached_property
+    def _path_key(self):
+        # normalized form of the path, used as the lookup key
+        return str(PurePath(self.path))
+
     def add_child(self, node):
-        if self.metadata is None:
-            if node.is_folder():
-                node.path = f"{node.metadata.visible_name}/"
-            else:
-                node.path = f"{node.metadata.visible_name}"
-        else:
-            node.path = f"{self.path}{node.metadata.visible_name}"
+        node.parent = self
         self.children.append(node)
 
     def is_folder(self):
@@ -347,53 +572,26 @@ class Node:
         elif self.metadata.type_ == 'CollectionType':
             return 'folder'
 
-    def render_to_disk(self, tempdir):
-        filestem = f"{tempdir}/{self.uuid}"
-        metafile = f"{filestem}.metadata"
-        contentfile = f"{filestem}.content"
-
-        with open(f"{metafile}", 'w') as METAFILE:
-            json.dump(self.metadata.as_dict(), METAFILE, indent=4)
+    def render_to_tar(self, tar):
+        """ Add the node's .metadata and .content files (and for documents,
+        its empty annotation and thumbnail folders) to an open tarfile """
+        _add_to_tar(tar, f"{self.uuid}.metadata",
+                    json_dumps(self.metadata.as_dict()))
 
-        if not self.content:
-            content = self._default_content()
-        with open(f"{contentfile}", 'w') as CONTENTFILE:
-            json.dump(content, CONTENTFILE, indent=4)
+        if self.content:
+            content_json = json_dumps(self.content)
+        else:
+            content_json = self._default_content_json()
+        _add_to_tar(tar, f"{self.uuid}.content", content_json)
 
         if not self.is_folder():
-            os.makedirs(f"{filestem}")
-            os.makedirs(f"{filestem}.thumbnails")
+            _add_to_tar(tar, f"{self.uuid}")
+            _add_to_tar(tar, f"{self.uuid}.thumbnails")
 
-    def _default_content(self):
+    def _default_content_json(self):
         if self.is_folder():
-            return {}
-
-        content = {}
-        if self.filetype == 'pdf':
-            content = {
-                'extraMetadata': {
-                    'LastFinelinerv2Color': 'Black',
-                    'LastFinelinerv2Size': '2',
-                    'LastPen': 'Finelinerv2',
-                    'LastTool': 'Finelinerv2'
-                },
-                'zoomMode': 'fitToHeight'
-            }
-        elif self.filetype == 'epub':
-            content = {
-                'extraMetadata': {
-                    'LastPen': 'Highlighterv2',
-                    'LastTool': 'Highlighterv2',
-                    'LastHighlighterv2Color': 'HighlighterYellow'
-                },
-                'coverPageNumber': 0,
-                'fontName': 'Noto Serif',
-                'lineHeight': 100,
-                'margins': 125,
-                'textAlignment': 'justify',
-                'textScale': 1
-            }
-        return content
+            return _EMPTY_CONTENT_JSON
+        return _DEFAULT_CONTENT_JSON.get(self.filetype, _EMPTY_CONTENT_JSON)
 
     def __repr__(self):
         if self.uuid == '':
@@ -412,44 +610,32 @@ class Node:
 class ContentTree:
     def __init__(self, metadata: str):
         self.tree = Node(uuid='')
+        self._by_uuid = {'': self.tree}
+        self._by_path = None
         self._build_tree(metadata)
 
-    def get_node_by_uuid(self, uuid: str, root_node: Node=None):
-        if root_node is None:
-            root_node = self.tree
-
-        if root_node.uuid == uuid:
-            return root_node
-
-        for node in root_node.children:
-            result = self.get_node_by_uuid(uuid, node)
-            if result is not None:
-                return result
-
-        return None
+    def add_node(self, parent: Node, node: Node):
+        parent.add_child(node)
+        self._by_uuid[node.uuid] = node
+        if self._by_path is not None:
+            self._by_path.setdefault(node._path_key, node)
 
-    def get_node_by_path(self, path: str, root_node: Node=None):
-        if root_node is None:
-            root_node = self.tree
+    def get_node_by_uuid(self, uuid: str):
+        return self._by_uuid.get(uuid)
 
-        root_path = PurePath(root_node.path)
-        ppath = PurePath(path)
-        if str(root_path) == str(ppath):
-            return root_node
-
-        for node in root_node.children:
-            result = self.get_node_by_path(path, node)
-            if result is not None:
-                return result
-
-        return None
+    def get_node_by_path(self, path: str):
+        if self._by_path is None:
+            # paths are only built once something is looked up by path; if
+            # two items share a path, the first one added wins
+            self._by_path = {}
+            for node in self._by_uuid.values():
+                self._by_path.setdefault(node._path_key, node)
+        return self._by_path.get(str(PurePath(path)))
 
     def _build_tree(self, metadata):
-        item_queue = deque(metadata)
-
-        while item_queue:
-            item = item_queue.popleft()
-
+        # first pass: create a node for every item, grouped by parent uuid
+        children = {}
+        for item in metadata:
             if 'deleted' not in item['metadata']:
                 item['metadata']['deleted'] = False
 
@@ -488,31 +674,28 @@ class ContentTree:
                             item['metadata']['version'],
                             item['metadata']['visibleName'])
 
-            if item['metadata']['parent'] == '':
-                # item has no parent, i.e. it's on the root level
-                self.tree.add_child(Node(uuid=uuid, metadata=meta,
-                                         filetype=item['filetype']))
-            else:
-                parent = self.get_node_by_uuid(item['metadata']['parent'])
-                if parent is None:
-                    # item _should_ have a parent, but we haven't seen it yet
-                    # so, send the item back to the end of the queue
-                    item_queue.append(item)
-                else:
-                    # item has a parent that we know about, so add it
-                    parent.add_child(Node(uuid=uuid, metadata=meta,
-                                          filetype=item['filetype']))
+            node = Node(uuid=uuid, metadata=meta, filetype=item['filetype'])
+            children.setdefault(meta.parent, []).append(node)
+
+        # second pass: attach nodes top-down starting at the root (items
+        # whose parent never shows up are left out of the tree)
+        stack = [self.tree]
+        while stack:
+            parent = stack.pop()
+            for node in children.pop(parent.uuid, []):
+                self.add_node(parent, node)
+                stack.append(node)
         return
 
 
 if __name__ == "__main__":
     args = docopt(__doc__, default_help=True, version='remtool 0.2')
 
-    reM = reMarkable(CONFIG['SSH_HOSTNAME'])
-
-    if args['put']:
-        reM.put(args['FILE'], args['FOLDER'], args['-f'], args['--clear'])
-    elif args['ls']:
-        reM.ls(args['PATH'])
-    elif args['show']:
-        reM.show(args['PATH'])
+    with reMarkable(CONFIG['SSH_HOSTNAME']) as reM:
+        if args['put']:
+            reM.put(args['FILE'], args['FOLDER'], args['-f'],
+                    args['--clear'])
+        elif args['ls']:
+            reM.ls(args['PATH'])
+        elif args['show']:
+            reM.show(args['PATH'])